@@ -1,6 +1,12 @@
-import os, json, time, math
+import os, time, math, bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+import msgpack
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 TFL_KEY = os.environ.get("tfl_key_primary")
 if not TFL_KEY:
@@ -11,6 +17,7 @@ DIRECTION_FILTER = "inbound"  # change later to expand to outbound too
 
 # Local files (direction-aware filenames)
 STATE_PATH = f"../www/{LINE_ID}-{DIRECTION_FILTER}-state.json"
+STATE_MP_PATH = STATE_PATH + ".mp"  # msgpack copy of the state - cheaper to reload than the JSON
 GEOJSON_OUT = f"../www/stops-{LINE_ID}-{DIRECTION_FILTER}.geojson"
 
 # Tuning knobs
@@ -18,47 +25,86 @@ POLL_SECONDS = 60                 # poll interval
 ARRIVAL_TTS_SEC = 30              # <= this means "arriving now"
 PREDICTION_MAX_AGE_SEC = 25 * 60  # expire predictions after this
 PHANTOM_GRACE_SEC = 6 * 60        # allow this much late before calling phantom
+STOP_POINT_BATCH = 20             # max naptanIds per StopPoint request
+STOP_POINT_WORKERS = 16           # concurrent StopPoint requests (<= adapter pool_maxsize)
+GEOJSON_REFRESH_SEC = 15 * 60     # rewrite unchanged geojson at least this often (keeps generatedAt fresh)
 
+# one pooled keep-alive connection to api.tfl.gov.uk, reused across cycles
 session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+)
+session.mount("https://", adapter)
+session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
 
 
-def fetch_stop_point(stop_id: str):
-    url = f"https://api.tfl.gov.uk/StopPoint/{stop_id}"
+def fetch_stop_points(stop_ids: list):
+    # batch form: /StopPoint/id1,id2,... returns a list (single id returns an object)
+    url = f"https://api.tfl.gov.uk/StopPoint/{','.join(stop_ids)}"
     r = session.get(url, params={"app_key": TFL_KEY}, timeout=10)
     r.raise_for_status()
-    return r.json()
+    data = orjson.loads(r.content)
+    if isinstance(data, dict):
+        data = data.get("stopPoints") or [data]
+    return data
 
 
-# get stop information if not already present - save api call as huge and only really need lat/long
-def ensure_stop_metadata(state, arrivals):
-    for a in arrivals:
-        stop_id = a.get("naptanId")
-        if not stop_id:
-            continue
-
-        st = state["stops"].get(stop_id)
-        if st and st.get("lat") is not None and st.get("lon") is not None:
-            continue
-
-        # create stub if needed
-        if not st:
-            state["stops"][stop_id] = {
-                "lat": None, "lon": None,
-                "name": a.get("stationName") or a.get("platformName") or stop_id
-            }
-
-        # fetch real coords once
-        try:
-            sp = fetch_stop_point(stop_id)
-            state["stops"][stop_id]["lat"] = sp.get("lat")
-            state["stops"][stop_id]["lon"] = sp.get("lon")
-            state["stops"][stop_id]["name"] = sp.get("commonName") or state["stops"][stop_id]["name"]
-        except Exception:
-            pass  # keep stub; try again next cycle
+def try_fetch_stop_points(stop_ids: list):
+    try:
+        return fetch_stop_points(stop_ids)
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        if status not in (400, 404) or len(stop_ids) == 1:
+            return []  # keep stubs; try again next cycle
+        # a bad id (e.g. retired naptanId) fails the whole batch - split so only it keeps its stub
+        mid = len(stop_ids) // 2
+        return try_fetch_stop_points(stop_ids[:mid]) + try_fetch_stop_points(stop_ids[mid:])
+    except Exception:
+        # throttled (retries exhausted on 429/5xx), timeout or network - don't add more requests
+        return []  # keep stubs; try again next cycle
+
+
+def match_stop_points(sps, wanted):
+    # (stop_id, stop point) for each requested id in a StopPoint response. TfL can answer a
+    # stop's naptanId with its parent stop area, listing the stop itself under "children"
+    stack = list(sps)
+    while stack:
+        sp = stack.pop()
+        sid = sp.get("naptanId") or sp.get("id")
+        if sid in wanted:
+            yield sid, sp
+        stack.extend(sp.get("children") or ())
 
 
-def now_ts():
-    return int(time.time())
+# get stop information if not already present - save api call as huge and only really need lat/long
+def fetch_stop_metadata(stops, missing):
+    # fetch real coords once, STOP_POINT_BATCH ids per request, requests run concurrently
+    chunks = [missing[i:i + STOP_POINT_BATCH] for i in range(0, len(missing), STOP_POINT_BATCH)]
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=min(STOP_POINT_WORKERS, len(chunks))) as ex:
+            results = list(ex.map(try_fetch_stop_points, chunks))
+    else:
+        results = [try_fetch_stop_points(c) for c in chunks]
+
+    wanted = set(missing)
+    resolved = set()
+    for sps in results:
+        for stop_id, sp in match_stop_points(sps, wanted):
+            resolved.add(stop_id)
+            st = stops[stop_id]
+            st["lat"] = sp.get("lat")
+            st["lon"] = sp.get("lon")
+            st["name"] = sp.get("commonName") or st["name"]
+
+    unresolved = wanted - resolved
+    if unresolved:
+        print(f"No StopPoint data for {len(unresolved)} stop(s), will retry next cycle: {sorted(unresolved)}")
+
+
+def valid_state(state):
+    return isinstance(state, dict) and all(
+        isinstance(state.get(k), dict) for k in ("stops", "predictions", "stopStats"))
 
 
 def load_state():
@@ -66,23 +112,61 @@ def load_state():
         "lastUpdated": None,
         "direction": DIRECTION_FILTER,
         "stops": {},          # stopId -> {lat, lon, name}
-        "predictions": {},    # stopId -> list of predictions
+        "predictions": {},    # stopId -> deque of predictions, oldest first
         "stopStats": {}       # stopId -> rolling stats
     }
 
+    # only trust the sidecar if it's at least as new as the JSON - save_state writes it last, so a
+    # newer JSON means it was restored / hand-edited, or written by a build without the sidecar
+    try:
+        json_mtime = os.path.getmtime(STATE_PATH)
+    except OSError:
+        json_mtime = 0.0
+
+    state = None
     try:
-        with open(STATE_PATH, "r", encoding="utf-8") as f:
-            txt = f.read().strip()
-            if not txt:
-                return empty
-            return json.loads(txt)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return empty
+        if os.path.getmtime(STATE_MP_PATH) >= json_mtime:
+            with open(STATE_MP_PATH, "rb") as f:
+                state = msgpack.unpackb(f.read(), raw=False)
+    except (OSError, ValueError, msgpack.UnpackException):
+        state = None
+
+    if not valid_state(state):
+        # no usable sidecar - fall back to the JSON state
+        try:
+            with open(STATE_PATH, "rb") as f:
+                txt = f.read().strip()
+                if not txt:
+                    return empty
+                state = orjson.loads(txt)
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return empty
+        if not valid_state(state):
+            return empty
+
+    # stored as lists; held in memory as deques so pruning can popleft
+    state["predictions"] = {sid: deque(preds) for sid, preds in state["predictions"].items()}
+    return state
+
+
+def write_atomic(path, data: bytes):
+    # write a sibling tmp file and swap it in so a crash mid-write can't leave a partial file;
+    # fsync first so after a power loss the rename can't land without the data behind it
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 
 def save_state(state):
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2)
+    # compact - the state file is only ever read back by this script.
+    # msgpack sidecar last, so its mtime is >= the JSON's and load_state picks it up;
+    # a crash between the two leaves the sidecar older and load_state falls back to the JSON
+    # default=list: prediction deques
+    write_atomic(STATE_PATH, orjson.dumps(state, default=list))
+    write_atomic(STATE_MP_PATH, msgpack.packb(state, use_bin_type=True, default=list))
 
 
 # root query - note attribute direction can be inbound or outbound
@@ -90,96 +174,129 @@ def fetch_arrivals():
     url = f"https://api.tfl.gov.uk/Line/{LINE_ID}/Arrivals"
     r = session.get(url, params={"app_key": TFL_KEY}, timeout=10)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)  # requests has already un-gzipped content
 
 
+# not on the per-arrival path any more (see process_arrivals) - kept for checking TfL timestamps by hand
 def parse_iso(ts_str):
     return int(datetime.fromisoformat(ts_str.replace("Z","+00:00")).timestamp())
 
 
 def filter_direction(arrivals, direction=DIRECTION_FILTER):
     # Some feeds use "direction", some "dir" — you said it's "direction" in your data
-    out = []
-    for a in arrivals:
-        if (a.get("direction") or "").lower() == direction.lower():
-            out.append(a)
-    return out
+    # TfL already sends it lower-case, so only lower() the ones that don't match outright
+    want = direction.lower()
+    return [a for a in arrivals
+            if (d := a.get("direction")) == want or (d or "").lower() == want]
 
 
-def update_predictions(state, arrivals):
-    ts = now_ts()
-    preds_by_stop = state["predictions"]
+def index_predictions(preds_by_stop):
+    # (stop, vehicle) -> unmatched predictions, oldest first; rebuilt each cycle, never persisted
+    index = {}
+    for stop_id, preds in preds_by_stop.items():
+        for p in preds:
+            if not p.get("matched"):
+                index.setdefault((stop_id, p["vehicleId"]), deque()).append(p)
+    return index
 
-    for a in arrivals:
-        stop_id = a.get("naptanId")
-        veh_id  = a.get("vehicleId")
-        tts     = a.get("timeToStation")  # seconds
-        exp_arr = a.get("expectedArrival")
 
-        if not stop_id or not veh_id or tts is None or not exp_arr:
-            continue
+def prune_in_place(preds, cutoff):
+    # appended in predictionTs order, so expired ones are at the head; True if any remain
+    while preds and preds[0]["predictionTs"] < cutoff:
+        preds.popleft()
+    return bool(preds)
 
-        rec = {
-            "vehicleId": veh_id,
-            "predictionTs": ts,
-            "timeToStation": int(tts),
-            "expectedArrivalTs": parse_iso(exp_arr),
-            "matched": False
-        }
-        preds_by_stop.setdefault(stop_id, []).append(rec)
 
-    # prune old predictions
-    for stop_id, preds in list(preds_by_stop.items()):
-        newp = []
-        for p in preds:
-            age = ts - p["predictionTs"]
-            if age <= PREDICTION_MAX_AGE_SEC:
-                newp.append(p)
-        if newp:
-            preds_by_stop[stop_id] = newp
-        else:
-            preds_by_stop.pop(stop_id, None)
+def new_stop_stats():
+    return {"samples": 0, "sumDriftSec": 0.0, "phantoms": 0}
 
 
-def detect_arrivals_and_score(state, arrivals):
+_EMPTY_STATS = new_stop_stats()  # read-only default for stops with no stats yet
+
+
+def process_arrivals(state, arrivals, ts):
     """
-    Time-only arrival detection.
+    Single pass over the cycle's arrivals: stop metadata, predictions and time-only arrival detection.
 
     Rule:
+      - every arrival is recorded as a prediction for (stop, vehicle) at ts.
       - if we see an inbound arrival for (stop, vehicle) with timeToStation <= ARRIVAL_TTS_SEC,
-        we treat actual arrival as ts_now + timeToStation.
-      - we match the earliest unmatched prediction for that (stop, vehicle).
+        we treat actual arrival as ts + timeToStation.
+      - we match the earliest unmatched prediction for that (stop, vehicle),
+        looked up in a per-cycle index rather than scanning the stop's list.
+      - stops without coords are collected and fetched in batches after the pass.
     """
-    ts_now = now_ts()
+    stops = state["stops"]
     preds_by_stop = state["predictions"]
     stats = state["stopStats"]
 
-    # Index current arrivals by (stop, vehicle) -> tts
-    curr = {}
+    # prune old predictions first so expired ones can't be matched;
+    # collect emptied stops and delete after, no snapshot of the dict needed
+    cutoff = ts - PREDICTION_MAX_AGE_SEC
+    empty = [sid for sid, preds in preds_by_stop.items() if not prune_in_place(preds, cutoff)]
+    for stop_id in empty:
+        del preds_by_stop[stop_id]
+
+    index = index_predictions(preds_by_stop)
+    missing = {}  # ordered set of stop ids still lacking coords
+    arrived = set()  # (stop, vehicle) already scored this cycle
+
+    # hoisted bound methods - this loop runs once per arrival
+    stops_get = stops.get
+    stats_get = stats.get
+    index_get = index.get
+    index_setdefault = index.setdefault
+    preds_setdefault = preds_by_stop.setdefault
+
     for a in arrivals:
-        stop_id = a.get("naptanId")
-        veh_id  = a.get("vehicleId")
-        tts     = a.get("timeToStation")
-        if stop_id and veh_id and tts is not None:
-            curr[(stop_id, veh_id)] = int(tts)
-
-    # For each current (stop,veh) that is "arriving", match a prediction
-    for (stop_id, veh_id), tts in curr.items():
-        if tts > ARRIVAL_TTS_SEC:
+        a_get = a.get
+        stop_id = a_get("naptanId")
+        if not stop_id:
             continue
+        veh_id  = a_get("vehicleId")
+        tts     = a_get("timeToStation")  # seconds
 
-        preds = preds_by_stop.get(stop_id, [])
-        # choose oldest unmatched prediction for this vehicle
-        candidate = None
-        for p in preds:
-            if (not p.get("matched")) and p.get("vehicleId") == veh_id:
-                candidate = p
-                break
+        # stop metadata - create stub if needed, fetch coords after the loop
+        st = stops_get(stop_id)
+        if not st:
+            stops[stop_id] = {
+                "lat": None, "lon": None,
+                "name": a_get("stationName") or a_get("platformName") or stop_id
+            }
+            missing[stop_id] = None
+        elif st.get("lat") is None or st.get("lon") is None:
+            missing[stop_id] = None
+
+        if not veh_id or tts is None:
+            continue
+        tts = int(tts)
+        key = (stop_id, veh_id)
+
+        # prediction - expected arrival is ts + timeToStation rather than parsing expectedArrival;
+        # the two agree to within a second or so at our poll cadence
+        rec = {
+            "vehicleId": veh_id,
+            "predictionTs": ts,
+            "timeToStation": tts,
+            "expectedArrivalTs": ts + tts,
+            "matched": False
+        }
+        preds_setdefault(stop_id, deque()).append(rec)
+        index_setdefault(key, deque()).append(rec)
+
+        # arrival - match the oldest unmatched prediction for this vehicle
+        if tts > ARRIVAL_TTS_SEC or key in arrived:
+            continue
+        arrived.add(key)
 
-        if candidate is None:
+        dq = index_get(key)
+        while dq and dq[0]["matched"]:
+            dq.popleft()
+        if not dq:
             continue
+        candidate = dq.popleft()
 
-        actual_arr_ts = ts_now + max(0, tts)
+        actual_arr_ts = ts + max(0, tts)
         predicted_arr_ts = candidate["predictionTs"] + candidate["timeToStation"]
         drift_sec = predicted_arr_ts - actual_arr_ts  # + => optimistic
 
@@ -187,43 +304,66 @@ def detect_arrivals_and_score(state, arrivals):
         candidate["actualArrivalTs"] = actual_arr_ts
         candidate["driftSec"] = drift_sec
 
-        s = stats.setdefault(stop_id, {
-            "samples": 0,
-            "sumDriftSec": 0.0,
-            "phantoms": 0
-        })
+        s = stats_get(stop_id)
+        if s is None:
+            s = stats[stop_id] = new_stop_stats()
         s["samples"] += 1
         s["sumDriftSec"] += float(drift_sec)
 
+    if missing:
+        fetch_stop_metadata(stops, list(missing))
+
     # phantom detection: predictions that are too old and never matched
+    late = ts - PHANTOM_GRACE_SEC
     for stop_id, preds in preds_by_stop.items():
-        s = stats.setdefault(stop_id, {"samples": 0, "sumDriftSec": 0.0, "phantoms": 0})
+        n = 0
         for p in preds:
-            if p.get("matched"):
-                continue
-            if ts_now > p["expectedArrivalTs"] + PHANTOM_GRACE_SEC:
+            if not p["matched"] and p["expectedArrivalTs"] < late:
                 p["matched"] = True
                 p["phantom"] = True
-                s["phantoms"] += 1
+                n += 1
+        if n:
+            s = stats_get(stop_id)
+            if s is None:
+                s = stats[stop_id] = new_stop_stats()
+            s["phantoms"] += n
+
+
+# |bias| < 60s green, < 180s amber, otherwise red
+_BIAS_THRESHOLDS = (60, 180)
+_BIAS_COLORS = ("#00ff00", "#f1c40f", "#ff0000")
 
 
 def bias_color(bias_sec):
-    ab = abs(bias_sec)
-    if ab < 60:
-        return "#00ff00"  # green
-    if ab < 180:
-        return "#f1c40f"  # amber
-    return "ff0000"      # red
+    # bisect_right so a bias of exactly 60 / 180 falls into the next band, as the < checks did
+    return _BIAS_COLORS[bisect.bisect_right(_BIAS_THRESHOLDS, abs(bias_sec))]
 
 
-def export_geojson(state):
+# signature + monotonic time of the last geojson actually written (process-local)
+_last_geo = {"sig": None, "at": 0.0}
+
+
+def export_geojson(state, generated_at):
+    # skip the rebuild + write when no stop's output could have changed
+    sig = hash((
+        tuple((sid, s["samples"], round(s["sumDriftSec"], 1), s["phantoms"])
+              for sid, s in state["stopStats"].items()),
+        tuple((sid, st.get("lat"), st.get("lon"), st.get("name"))
+              for sid, st in state["stops"].items()),
+    ))
+    now = time.monotonic()
+    if sig == _last_geo["sig"] and now - _last_geo["at"] < GEOJSON_REFRESH_SEC:
+        return False
+
     features = []
+    stats_get = state["stopStats"].get
+    direction = state.get("direction")
     for stop_id, stop in state["stops"].items():
         lat = stop.get("lat"); lon = stop.get("lon")
         if lat is None or lon is None:
             continue
 
-        st = state["stopStats"].get(stop_id, {"samples": 0, "sumDriftSec": 0.0, "phantoms": 0})
+        st = stats_get(stop_id, _EMPTY_STATS)
         samples = st["samples"]
         bias_sec = (st["sumDriftSec"] / samples) if samples > 0 else 0.0
         phantom_rate = (st["phantoms"] / max(1, samples + st["phantoms"]))
@@ -233,7 +373,7 @@ def export_geojson(state):
             "properties": {
                 "stopId": stop_id,
                 "name": stop.get("name"),
-                "direction": state.get("direction"),
+                "direction": direction,
                 "predictionDriftSec": round(bias_sec, 1),
                 "samples": samples,
                 "phantomRate": round(phantom_rate, 3),
@@ -249,36 +389,53 @@ def export_geojson(state):
     geo = {
         "type": "FeatureCollection",
         "features": features,
-        "generatedAt": datetime.now(timezone.utc).isoformat(),
+        "generatedAt": generated_at,
         "lineId": LINE_ID,
-        "direction": state.get("direction")
+        "direction": direction
     }
-    with open(GEOJSON_OUT, "w", encoding="utf-8") as f:
-        json.dump(geo, f, indent=2)
+    with open(GEOJSON_OUT, "wb") as f:
+        f.write(orjson.dumps(geo, option=orjson.OPT_INDENT_2))
+
+    _last_geo["sig"] = sig
+    _last_geo["at"] = now
+    return True
 
 
 def one_cycle(state):
     arrivals = fetch_arrivals()
+
+    # one clock read per cycle (just after the fetch, so timeToStation lines up), shared by every step
+    ts = int(time.time())
+    iso = datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
     arrivals = filter_direction(arrivals, DIRECTION_FILTER)
 
-    ensure_stop_metadata(state, arrivals)
-    update_predictions(state, arrivals)
-    detect_arrivals_and_score(state, arrivals)
-    export_geojson(state)
+    process_arrivals(state, arrivals, ts)
+    wrote = export_geojson(state, iso)
 
-    state["lastUpdated"] = datetime.now(timezone.utc).isoformat()
+    state["lastUpdated"] = iso
     save_state(state)
+    return wrote
 
 
 def main():
     state = load_state()
+    next_t = time.monotonic()
     while True:
         try:
-            one_cycle(state)
-            print(f"[{state['lastUpdated']}] wrote {GEOJSON_OUT} ({state.get('direction')}) with {len(state['stops'])} stops")
+            wrote = one_cycle(state)
+            verb = "wrote" if wrote else "unchanged"
+            print(f"[{state['lastUpdated']}] {verb} {GEOJSON_OUT} ({state.get('direction')}) with {len(state['stops'])} stops")
         except Exception as e:
             print("Cycle error:", repr(e))
-        time.sleep(POLL_SECONDS)
+
+        # schedule against deadlines so the period stays POLL_SECONDS however long the cycle took
+        next_t += POLL_SECONDS
+        delay = next_t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            print(f"Cycle overran poll interval by {-delay:.1f}s")
+            next_t = time.monotonic()  # don't try to catch up with back-to-back cycles
 
 
 if __name__ == "__main__":